@@ -7,7 +7,7 @@
 # USAGE: opensnoop [-h] [-T] [-U] [-x] [-p PID] [-t TID]
 #                  [--cgroupmap CGROUPMAP] [--mntnsmap MNTNSMAP] [-u UID]
 #                  [-d DURATION] [-n NAME] [-F] [-e] [-f FLAG_FILTER]
-#                  [-b BUFFER_PAGES]
+#                  [-b BUFFER_PAGES] [--batch BATCH]
 #
 # Copyright (c) 2015 Brendan Gregg.
 # Licensed under the Apache License, Version 2.0 (the "License")
@@ -23,11 +23,20 @@
 from __future__ import print_function
 from bcc import ArgString, BPF
 from bcc.containers import filter_by_containers
-from bcc.utils import printb
+from bcc.utils import get_online_cpus
 import argparse
-from collections import defaultdict
+import ctypes as ct
 from datetime import datetime, timedelta
+import errno
 import os
+import re
+import struct
+import sys
+from threading import Event, Thread
+try:
+    from queue import Full, Queue
+except ImportError:
+    from Queue import Full, Queue
 
 # arguments
 examples = """examples:
@@ -80,12 +89,17 @@ parser.add_argument("-f", "--flag_filter", action="append",
 parser.add_argument("-F", "--full-path", action="store_true",
     help="show full path for an open file with relative path")
 parser.add_argument("-b", "--buffer-pages", type=int, default=64,
-    help="size of the perf ring buffer "
+    help="size of the perf or BPF ring buffer in pages per CPU "
         "(must be a power of two number of pages and defaults to 64)")
+parser.add_argument("--batch", type=int, default=1,
+    help="number of events to buffer before waking up the reader "
+        "(defaults to 1)")
 args = parser.parse_args()
 debug = 0
 if args.duration:
     args.duration = timedelta(seconds=int(args.duration))
+if args.batch < 1:
+    exit("Bad batch size: %d" % args.batch)
 flag_filter_mask = 0
 for flag in args.flag_filter or []:
     if not flag.startswith('O_'):
@@ -100,39 +114,87 @@ bpf_text = """
 #include <uapi/linux/ptrace.h>
 #include <uapi/linux/limits.h>
 #include <linux/sched.h>
-#ifdef FULLPATH
-#include <linux/fs_struct.h>
-#include <linux/dcache.h>
 
-#define MAX_ENTRIES 32
-
-enum event_type {
-    EVENT_ENTRY,
-    EVENT_END,
-};
+#ifdef COMM_FILTER
+// true if COMM_FILTER is a substring of comm
+static inline bool comm_matches(const char *comm)
+{
+    const char target[] = COMM_FILTER;
+    int i, j;
+
+    #pragma unroll
+    for (i = 0; i <= TASK_COMM_LEN - (int)sizeof(target); i++) {
+        #pragma unroll
+        for (j = 0; j < sizeof(target) - 1; j++) {
+            if (comm[i + j] != target[j])
+                break;
+        }
+        if (j == sizeof(target) - 1)
+            return true;
+    }
+    return false;
+}
 #endif
 
+// what the kprobe entry stashes for its return probe; comm and id are
+// taken on return, as they are the same for the whole syscall
 struct val_t {
-    u64 id;
-    char comm[TASK_COMM_LEN];
     const char *fname;
     int flags; // EXTENDED_STRUCT_MEMBER
 };
 
 struct data_t {
     u64 id;
-    u64 ts;
-    u32 uid;
+    u64 ts; // TIMESTAMP_STRUCT_MEMBER
+    u32 uid; // UID_STRUCT_MEMBER
     int ret;
     char comm[TASK_COMM_LEN];
-#ifdef FULLPATH
-    enum event_type type;
-#endif
+    int flags; // EXTENDED_DATA_MEMBER
     char name[NAME_MAX];
-    int flags; // EXTENDED_STRUCT_MEMBER
 };
 
-BPF_PERF_OUTPUT(events);
+// events are submitted up to the NUL terminator of name only
+#define BASE_EVENT_SIZE ((size_t)(&((struct data_t*)0)->name))
+#define EVENT_SIZE(X) (BASE_EVENT_SIZE + ((size_t)(X)))
+
+// number of name bytes to submit for a bpf_probe_read_*_str() result
+static inline u32 name_len(int len)
+{
+    if (len <= 0)
+        return 1; // failed reads leave an empty string
+    return len & NAME_MAX; // bounded for the verifier
+}
+
+PERF_TABLE
+
+#ifdef RINGBUF
+BPF_PERCPU_ARRAY(lost_cnt, u64, 1);
+
+// count records dropped because the ring buffer was full
+static inline void count_lost()
+{
+    int zero = 0;
+    u64 *cnt = lost_cnt.lookup(&zero);
+
+    if (cnt)
+        (*cnt)++;
+}
+#endif
+
+#ifdef WAKEUP_BATCH
+BPF_PERCPU_ARRAY(wakeup_cnt, u32, 1);
+
+// only wake the reader up for every WAKEUP_BATCH-th event on this CPU
+static inline u64 wakeup_flags()
+{
+    int zero = 0;
+    u32 *cnt = wakeup_cnt.lookup(&zero);
+
+    if (cnt && ++*cnt % WAKEUP_BATCH)
+        return BPF_RB_NO_WAKEUP;
+    return 0;
+}
+#endif
 """
 
 bpf_text_kprobe = """
@@ -143,8 +205,9 @@ int trace_return(struct pt_regs *ctx)
     u64 id = bpf_get_current_pid_tgid();
     struct val_t *valp;
     struct data_t data = {};
+    int len;
 
-    u64 tsp = bpf_ktime_get_ns();
+    u64 tsp = bpf_ktime_get_ns(); // TIMESTAMP_STRUCT_MEMBER
 
     valp = infotmp.lookup(&id);
     if (valp == 0) {
@@ -152,12 +215,12 @@ int trace_return(struct pt_regs *ctx)
         return 0;
     }
 
-    bpf_probe_read_kernel(&data.comm, sizeof(data.comm), valp->comm);
-    bpf_probe_read_user_str(&data.name, sizeof(data.name), (void *)valp->fname);
-    data.id = valp->id;
-    data.ts = tsp / 1000;
-    data.uid = bpf_get_current_uid_gid();
-    data.flags = valp->flags; // EXTENDED_STRUCT_MEMBER
+    bpf_get_current_comm(&data.comm, sizeof(data.comm));
+    len = bpf_probe_read_user_str(&data.name, sizeof(data.name), (void *)valp->fname);
+    data.id = id;
+    data.ts = tsp; // TIMESTAMP_STRUCT_MEMBER
+    data.uid = bpf_get_current_uid_gid(); // UID_STRUCT_MEMBER
+    data.flags = valp->flags; // EXTENDED_DATA_MEMBER
     data.ret = PT_REGS_RC(ctx);
 
     SUBMIT_DATA
@@ -182,7 +245,7 @@ bpf_text_kprobe_header_openat2 = """
 #include <uapi/linux/openat2.h>
 int syscall__trace_entry_openat2(struct pt_regs *ctx, int dfd, const char __user *filename, struct open_how *how)
 {
-    int flags = how->flags;
+    int flags = how->flags; // EXTENDED_STRUCT_MEMBER
 """
 
 bpf_text_kprobe_body = """
@@ -190,7 +253,6 @@ bpf_text_kprobe_body = """
     u64 id = bpf_get_current_pid_tgid();
     u32 pid = id >> 32; // PID is higher part
     u32 tid = id;       // Cast and get the lower part
-    u32 uid = bpf_get_current_uid_gid();
 
     PID_TID_FILTER
     UID_FILTER
@@ -200,12 +262,16 @@ bpf_text_kprobe_body = """
         return 0;
     }
 
-    if (bpf_get_current_comm(&val.comm, sizeof(val.comm)) == 0) {
-        val.id = id;
-        val.fname = filename;
-        val.flags = flags; // EXTENDED_STRUCT_MEMBER
-        infotmp.update(&id, &val);
+#ifdef COMM_FILTER
+    char comm[TASK_COMM_LEN];
+    if (bpf_get_current_comm(&comm, sizeof(comm)) != 0 || !comm_matches(comm)) {
+        return 0;
     }
+#endif
+
+    val.fname = filename;
+    val.flags = flags; // EXTENDED_STRUCT_MEMBER
+    infotmp.update(&id, &val);
 
     return 0;
 };
@@ -243,15 +309,15 @@ KRETFUNC_PROBE(FNNAME, struct pt_regs *regs, int ret)
 {
     int dfd = PT_REGS_PARM1(regs);
     const char __user *filename = (char *)PT_REGS_PARM2(regs);
-    struct open_how __user how;
-    int flags;
+    struct open_how __user how; // EXTENDED_STRUCT_MEMBER
+    int flags; // EXTENDED_STRUCT_MEMBER
 
-    bpf_probe_read_user(&how, sizeof(struct open_how), (struct open_how*)PT_REGS_PARM3(regs));
-    flags = how.flags;
+    bpf_probe_read_user(&how, sizeof(struct open_how), (struct open_how*)PT_REGS_PARM3(regs)); // EXTENDED_STRUCT_MEMBER
+    flags = how.flags; // EXTENDED_STRUCT_MEMBER
 #else
 KRETFUNC_PROBE(FNNAME, int dfd, const char __user *filename, struct open_how __user *how, int ret)
 {
-    int flags = how->flags;
+    int flags = how->flags; // EXTENDED_STRUCT_MEMBER
 #endif
 """
 
@@ -259,7 +325,6 @@ bpf_text_kfunc_body = """
     u64 id = bpf_get_current_pid_tgid();
     u32 pid = id >> 32; // PID is higher part
     u32 tid = id;       // Cast and get the lower part
-    u32 uid = bpf_get_current_uid_gid();
 
     PID_TID_FILTER
     UID_FILTER
@@ -270,14 +335,19 @@ bpf_text_kfunc_body = """
 
     struct data_t data = {};
     bpf_get_current_comm(&data.comm, sizeof(data.comm));
+#ifdef COMM_FILTER
+    if (!comm_matches(data.comm)) {
+        return 0;
+    }
+#endif
 
-    u64 tsp = bpf_ktime_get_ns();
+    u64 tsp = bpf_ktime_get_ns(); // TIMESTAMP_STRUCT_MEMBER
 
-    bpf_probe_read_user_str(&data.name, sizeof(data.name), (void *)filename);
+    int len = bpf_probe_read_user_str(&data.name, sizeof(data.name), (void *)filename);
     data.id    = id;
-    data.ts    = tsp / 1000;
-    data.uid   = bpf_get_current_uid_gid();
-    data.flags = flags; // EXTENDED_STRUCT_MEMBER
+    data.ts    = tsp; // TIMESTAMP_STRUCT_MEMBER
+    data.uid   = bpf_get_current_uid_gid(); // UID_STRUCT_MEMBER
+    data.flags = flags; // EXTENDED_DATA_MEMBER
     data.ret   = ret;
 
     SUBMIT_DATA
@@ -294,89 +364,100 @@ fnname_openat2 = b.get_syscall_prefix().decode() + 'openat2'
 if b.ksymname(fnname_openat2) == -1:
     fnname_openat2 = None
 
-if args.full_path:
-    bpf_text = "#define FULLPATH\n" + bpf_text
+# the program is assembled from parts and its placeholders are then
+# substituted in a single pass
+defines = []
+if args.name:
+    defines.append('#define COMM_FILTER "%s"' % "".join(
+        "\\x%02x" % c for c in bytearray(bytes(args.name))))
+
+# ring buffer flags for the submit; perf buffers batch wakeups themselves
+wakeup_flags = "0"
+if BPF.kernel_struct_has_field(b'bpf_ringbuf', b'waitq') == 1:
+    PERF_MODE = "USE_BPF_RING_BUF"
+    # -b is per CPU, as for the perf buffers, but the ring buffer is shared
+    # by all CPUs and must be a power of two number of pages
+    ringbuf_pages = args.buffer_pages * len(get_online_cpus())
+    ringbuf_pages = 1 << (ringbuf_pages - 1).bit_length()
+    perf_table = 'BPF_RINGBUF_OUTPUT(events, %d);' % ringbuf_pages
+    defines.append("#define RINGBUF")
+    if args.batch > 1:
+        defines.append("#define WAKEUP_BATCH %d" % args.batch)
+        wakeup_flags = "wakeup_flags()"
+else:
+    PERF_MODE = "USE_BPF_PERF_BUF"
+    perf_table = 'BPF_PERF_OUTPUT(events);'
+
+def submit_event(size, flags):
+    if PERF_MODE == "USE_BPF_RING_BUF":
+        return ("if (events.ringbuf_output(&data, %s, %s) != 0) "
+                "{ count_lost(); }" % (size, flags))
+    return "events.perf_submit(ctx, &data, %s);" % size
+
+
+parts = [filter_by_containers(args)] + defines + [bpf_text]
 
 is_support_kfunc = BPF.support_kfunc()
 if is_support_kfunc:
-    bpf_text += bpf_text_kfunc_header_open.replace('FNNAME', fnname_open)
-    bpf_text += bpf_text_kfunc_body
+    parts.append(bpf_text_kfunc_header_open.replace('FNNAME', fnname_open))
+    parts.append(bpf_text_kfunc_body)
 
-    bpf_text += bpf_text_kfunc_header_openat.replace('FNNAME', fnname_openat)
-    bpf_text += bpf_text_kfunc_body
+    parts.append(bpf_text_kfunc_header_openat.replace('FNNAME', fnname_openat))
+    parts.append(bpf_text_kfunc_body)
 
     if fnname_openat2:
-        bpf_text += bpf_text_kfunc_header_openat2.replace('FNNAME', fnname_openat2)
-        bpf_text += bpf_text_kfunc_body
+        parts.append(bpf_text_kfunc_header_openat2.replace('FNNAME', fnname_openat2))
+        parts.append(bpf_text_kfunc_body)
 else:
-    bpf_text += bpf_text_kprobe
+    parts.append(bpf_text_kprobe)
 
-    bpf_text += bpf_text_kprobe_header_open
-    bpf_text += bpf_text_kprobe_body
+    parts.append(bpf_text_kprobe_header_open)
+    parts.append(bpf_text_kprobe_body)
 
-    bpf_text += bpf_text_kprobe_header_openat
-    bpf_text += bpf_text_kprobe_body
+    parts.append(bpf_text_kprobe_header_openat)
+    parts.append(bpf_text_kprobe_body)
 
     if fnname_openat2:
-        bpf_text += bpf_text_kprobe_header_openat2
-        bpf_text += bpf_text_kprobe_body
+        parts.append(bpf_text_kprobe_header_openat2)
+        parts.append(bpf_text_kprobe_body)
 
+subs = {'PERF_TABLE': perf_table}
 if args.tid:  # TID trumps PID
-    bpf_text = bpf_text.replace('PID_TID_FILTER',
-        'if (tid != %s) { return 0; }' % args.tid)
+    subs['PID_TID_FILTER'] = 'if (tid != %s) { return 0; }' % args.tid
 elif args.pid:
-    bpf_text = bpf_text.replace('PID_TID_FILTER',
-        'if (pid != %s) { return 0; }' % args.pid)
+    subs['PID_TID_FILTER'] = 'if (pid != %s) { return 0; }' % args.pid
 else:
-    bpf_text = bpf_text.replace('PID_TID_FILTER', '')
+    subs['PID_TID_FILTER'] = ''
 if args.uid:
-    bpf_text = bpf_text.replace('UID_FILTER',
-        'if (uid != %s) { return 0; }' % args.uid)
+    subs['UID_FILTER'] = ('u32 uid = bpf_get_current_uid_gid();\n'
+        '    if (uid != %s) { return 0; }' % args.uid)
 else:
-    bpf_text = bpf_text.replace('UID_FILTER', '')
-bpf_text = filter_by_containers(args) + bpf_text
+    subs['UID_FILTER'] = ''
 if args.flag_filter:
-    bpf_text = bpf_text.replace('FLAGS_FILTER',
-        'if (!(flags & %d)) { return 0; }' % flag_filter_mask)
+    subs['FLAGS_FILTER'] = ('if (!(flags & %d)) { return 0; }' %
+        flag_filter_mask)
 else:
-    bpf_text = bpf_text.replace('FLAGS_FILTER', '')
-if not (args.extended_fields or args.flag_filter):
-    bpf_text = '\n'.join(x for x in bpf_text.split('\n')
-        if 'EXTENDED_STRUCT_MEMBER' not in x)
-
-if args.full_path:
-    bpf_text = bpf_text.replace('SUBMIT_DATA', """
-    data.type = EVENT_ENTRY;
-    events.perf_submit(ctx, &data, sizeof(data));
-
-    if (data.name[0] != '/') { // relative path
-        struct task_struct *task;
-        struct dentry *dentry;
-        int i;
+    subs['FLAGS_FILTER'] = ''
 
-        task = (struct task_struct *)bpf_get_current_task_btf();
-        dentry = task->fs->pwd.dentry;
+subs['SUBMIT_DATA'] = submit_event("EVENT_SIZE(name_len(len))", wakeup_flags)
 
-        for (i = 1; i < MAX_ENTRIES; i++) {
-            bpf_probe_read_kernel(&data.name, sizeof(data.name), (void *)dentry->d_name.name);
-            data.type = EVENT_ENTRY;
-            events.perf_submit(ctx, &data, sizeof(data));
+bpf_text = re.sub(r'\b(%s)\b' % '|'.join(subs),
+                  lambda m: subs[m.group(1)], '\n'.join(parts))
 
-            if (dentry == dentry->d_parent) { // root directory
-                break;
-            }
-
-            dentry = dentry->d_parent;
-        }
-    }
-
-    data.type = EVENT_END;
-    events.perf_submit(ctx, &data, sizeof(data));
-    """)
-else:
-    bpf_text = bpf_text.replace('SUBMIT_DATA', """
-    events.perf_submit(ctx, &data, sizeof(data));
-    """)
+# leave out the members and helper calls that the given options do not
+# need: flags are read for -f, but only submitted for -e
+unused_members = []
+if not (args.extended_fields or args.flag_filter):
+    unused_members.append('EXTENDED_STRUCT_MEMBER')
+if not args.extended_fields:
+    unused_members.append('EXTENDED_DATA_MEMBER')
+if not args.timestamp:
+    unused_members.append('TIMESTAMP_STRUCT_MEMBER')
+if not args.print_uid:
+    unused_members.append('UID_STRUCT_MEMBER')
+if unused_members:
+    bpf_text = '\n'.join(x for x in bpf_text.split('\n')
+        if not any(m in x for m in unused_members))
 
 if debug or args.ebpf:
     print(bpf_text)
@@ -408,73 +489,215 @@ print("%-6s %-16s %4s %3s " %
 if args.extended_fields:
     print("%-9s" % ("FLAGS"), end="")
 print("PATH")
+sys.stdout.flush()
 
-class EventType(object):
-    EVENT_ENTRY = 0
-    EVENT_END = 1
-
-entries = defaultdict(list)
-
-# process event
-def print_event(cpu, data, size):
-    event = b["events"].event(data)
-    global initial_ts
-
-    if not args.full_path or event.type == EventType.EVENT_END:
-        skip = False
+# output line format, matching the header above, so that each event is
+# formatted with a single operation
+line_fmt = b""
+if args.timestamp:
+    line_fmt += b"%-14.9f"
+if args.print_uid:
+    line_fmt += b"%-6d"
+line_fmt += b"%-6d %-16s %4d %3d "
+if args.extended_fields:
+    line_fmt += b"%08o "
+line_fmt += b"%s\n"
+
+# output lines are collected per drained batch and written to the binary
+# stdout stream by a separate thread, so that draining the buffer does not
+# wait on stdout
+out = getattr(sys.stdout, "buffer", sys.stdout)
+batch = bytearray()
+BATCH_FLUSH_BYTES = 65536
+
+# struct data_t as laid out by the BPF program: id, [ts,] [uid,] ret, comm,
+# [flags,] followed by name, which is only submitted up to its NUL
+TASK_COMM_LEN = 16
+NAME_MAX = 255
+hdr_fields = "=Q%s%si" % ("Q" if args.timestamp else "",
+                          "I" if args.print_uid else "")
+ret_idx = len(hdr_fields) - 2
+comm_off = struct.calcsize(hdr_fields)
+flags_off = comm_off + TASK_COMM_LEN
+data_hdr = struct.Struct("%s%dx%s" % (hdr_fields, TASK_COMM_LEN,
+                                      "4x" if args.extended_fields else ""))
+name_off = data_hdr.size
+flags_fmt = struct.Struct("=i")
+
+# slice a NUL-terminated string of at most size bytes out of buf
+def cstr(buf, start, size):
+    end = buf.find(b"\0", start, start + size)
+    return buf[start:end if end >= 0 else start + size]
+
+# build the perf buffer callback once, with the output options bound as
+# locals, so that no per-event option lookups or dispatch are needed
+def make_printer(timestamp, print_uid, tid, extended_fields, full_path,
+                 failed, string_at=ct.string_at,
+                 unpack_hdr=data_hdr.unpack_from,
+                 unpack_flags=flags_fmt.unpack_from, line_fmt=line_fmt,
+                 write=batch.extend):
+    pid_shift = 0 if tid else 32
+
+    def print_line(buf, hdr, path):
+        global initial_ts
+
+        ret = hdr[ret_idx]
+        if timestamp and not initial_ts:
+            initial_ts = hdr[1]
+
+        if failed and ret >= 0:
+            return
 
         # split return value into FD and errno columns
-        if event.ret >= 0:
-            fd_s = event.ret
+        if ret >= 0:
+            fd_s = ret
             err = 0
         else:
             fd_s = -1
-            err = - event.ret
-
-        if not initial_ts:
-            initial_ts = event.ts
-
-        if args.failed and (event.ret >= 0):
-            skip = True
-
-        if args.name and bytes(args.name) not in event.comm:
-            skip = True
-
-        if not skip:
-            if args.timestamp:
-                delta = event.ts - initial_ts
-                printb(b"%-14.9f" % (float(delta) / 1000000), nl="")
-
-            if args.print_uid:
-                printb(b"%-6d" % event.uid, nl="")
-
-            printb(b"%-6d %-16s %4d %3d " %
-                   (event.id & 0xffffffff if args.tid else event.id >> 32,
-                    event.comm, fd_s, err), nl="")
-
-            if args.extended_fields:
-                printb(b"%08o " % event.flags, nl="")
-
-            if not args.full_path:
-                printb(b"%s" % event.name)
-            else:
-                paths = entries[event.id]
-                paths.reverse()
-                printb(b"%s" % os.path.join(*paths))
-
-        if args.full_path:
-            try:
-                del(entries[event.id])
-            except Exception:
-                pass
-    elif event.type == EventType.EVENT_ENTRY:
-        entries[event.id].append(event.name)
+            err = - ret
+
+        cols = []
+        if timestamp:
+            cols.append(float(hdr[1] - initial_ts) / 1000000000)
+        if print_uid:
+            cols.append(hdr[ret_idx - 1])
+        cols += ((hdr[0] >> pid_shift) & 0xffffffff,
+                 cstr(buf, comm_off, TASK_COMM_LEN), fd_s, err)
+        if extended_fields:
+            cols += unpack_flags(buf, flags_off)
+        cols.append(path)
+        write(line_fmt % tuple(cols))
+        # a ring buffer poll keeps draining while records keep arriving, so
+        # hand the output over without waiting for it to return
+        if len(batch) >= BATCH_FLUSH_BYTES:
+            flush_batch()
+
+    if not full_path:
+        def print_event(cpu, data, size):
+            buf = string_at(data, size)
+            print_line(buf, unpack_hdr(buf), cstr(buf, name_off, NAME_MAX))
+
+        return print_event
+
+    # Relative paths are resolved against the current directory of the
+    # process, read from /proc for every such event when it is printed. The
+    # directory is not cached, as processes commonly chdir() and open a
+    # relative path right after (shells, make, tar). This is still racy if
+    # the process changes directory or exits between the open() and the
+    # read, in which case the path is wrong or shown as it was passed.
+    def resolve(tgid, name):
+        try:
+            cwd = os.readlink(b"/proc/%d/cwd" % tgid)
+        except OSError:
+            return name
+        if cwd == b"/":
+            return b"/" + name
+        return cwd + b"/" + name
+
+    def print_event(cpu, data, size):
+        buf = string_at(data, size)
+        hdr = unpack_hdr(buf)
+        name = cstr(buf, name_off, NAME_MAX)
+        if not name.startswith(b"/"):
+            name = resolve(hdr[0] >> 32, name)
+        print_line(buf, hdr, name)
+
+    return print_event
+
+
+print_event = make_printer(args.timestamp, args.print_uid, args.tid,
+                           args.extended_fields, args.full_path, args.failed)
 
 # loop with callback to print_event
-b["events"].open_perf_buffer(print_event, page_cnt=args.buffer_pages)
+if PERF_MODE == "USE_BPF_RING_BUF":
+    b["events"].open_ring_buffer(print_event)
+    poll, consume = b.ring_buffer_poll, b.ring_buffer_consume
+    lost_cnt = b["lost_cnt"]
+else:
+    b["events"].open_perf_buffer(print_event, page_cnt=args.buffer_pages,
+                                 wakeup_events=args.batch)
+    poll, consume = b.perf_buffer_poll, b.perf_buffer_consume
+
+# perf buffers report lost samples themselves; for the ring buffer, report
+# the drops counted by the BPF program in the same way
+lost_total = 0
+
+def check_lost():
+    global lost_total
+    if PERF_MODE != "USE_BPF_RING_BUF":
+        return
+    lost = lost_cnt.sum(0).value
+    if lost > lost_total:
+        print("Possibly lost %d samples" % (lost - lost_total),
+              file=sys.stderr)
+        lost_total = lost
+
+
+writer_q = Queue(maxsize=64)
+writer_broken = Event()
+writer_error = []
+
+def write_batches():
+    while True:
+        buf = writer_q.get()
+        if buf is None:
+            return
+        if writer_broken.is_set():
+            # keep draining the queue so that the reader never blocks
+            continue
+        try:
+            out.write(buf)
+            out.flush()
+        except Exception as e:
+            writer_error.append(e)
+            writer_broken.set()
+
+def queue_put(buf):
+    # never block for good on a writer that is gone
+    while writer.is_alive():
+        try:
+            writer_q.put(buf, timeout=0.1)
+            return
+        except Full:
+            pass
+    writer_broken.set()
+
+def flush_batch():
+    if batch:
+        queue_put(bytes(batch))
+        del batch[:]
+
+
+writer = Thread(target=write_batches)
+writer.daemon = True
+writer.start()
+
 start_time = datetime.now()
-while not args.duration or datetime.now() - start_time < args.duration:
-    try:
-        b.perf_buffer_poll()
-    except KeyboardInterrupt:
+try:
+    while not args.duration or datetime.now() - start_time < args.duration:
+        # wait for a wakeup, which drains everything ready at that point
+        poll(timeout=100)
+        if args.batch > 1:
+            # drain what is left below the wakeup threshold
+            consume()
+        check_lost()
+        flush_batch()
+        if writer_broken.is_set():
+            break
+except KeyboardInterrupt:
+    pass
+
+try:
+    flush_batch()
+    queue_put(None)
+    writer.join()
+except KeyboardInterrupt:
+    exit()
+
+if writer_error:
+    err = writer_error[0]
+    if isinstance(err, IOError) and err.errno == errno.EPIPE:
         exit()
+    exit("Error writing output: %s" % err)
+elif writer_broken.is_set():
+    exit("Output writer stopped unexpectedly")